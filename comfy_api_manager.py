@@ -1,12 +1,30 @@
 # comfy_api_manager.py
 
-import websocket
+import asyncio
+import io
 import uuid
 import json
-import urllib.request
-import urllib.parse
 import os
+import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
+
+# orjson (C extension) decodes the per-frame websocket JSON and the workflow
+# template several times faster than stdlib json; fall back if not installed.
+try:
+    import orjson
+
+    def _json_loads(data):
+        return orjson.loads(data)
+
+    def _json_dumps(obj):
+        return orjson.dumps(obj)
+except ImportError:
+    def _json_loads(data):
+        return json.loads(data)
+
+    def _json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
 import subprocess
 import time
 import socket
@@ -18,32 +36,80 @@ class ComfyAPIManager:
 
     def __init__(self, server_address, conda_env, comfyui_path, workflow_path, node_ids):
         self.server_address = server_address
+        host, port = server_address.split(':')
+        self._host = host
+        self._port = int(port)
+        self._http_base = f"http://{server_address}"
+        self._ws_base = f"ws://{server_address}"
         self.client_id = str(uuid.uuid4())
         self.server_process = None
         
         self.conda_env_name = conda_env
         self.comfyui_path = comfyui_path
         self.workflow_api_json_path = workflow_path
-        
+
+        # The workflow file is static config; read it once and re-parse the
+        # cached bytes per run (each parse yields a fresh, safely mutable dict).
+        with open(self.workflow_api_json_path, 'rb') as f:
+            self._workflow_bytes = f.read()
+
         self.load_image_node_id = node_ids["load_image"]
         self.clip_text_node_id = node_ids["clip_text"]
         self.seed_node_id = node_ids["seed"]
         self.image_scaler_node_id = node_ids.get("image_scaler") # Use .get for graceful failure
 
+        # Sync session for the server lifecycle code, which runs in a thread.
+        self.http = requests.Session()
+        self.http.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+        # Async session for the workflow hot path (upload/prompt/view/history
+        # and the websocket). Created lazily so it binds to the bot's event loop.
+        self._aio = None
+
+        # One long-lived websocket subscription shared by all prompts, so a
+        # new prompt can be uploaded and queued while the previous one is
+        # still executing on the GPU.
+        self._ws_reader = None
+        self._ws_connected = asyncio.Event()
+        self._pending = {}   # prompt_id -> Future resolved on completion
+        self._finished = set()  # completions seen before a future was registered
+
+        # Short-TTL cache for the async liveness probe.
+        self._alive_until = 0.0
+
+    async def _get_aio_session(self):
+        if self._aio is None or self._aio.closed:
+            self._aio = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=8, keepalive_timeout=120)
+            )
+        return self._aio
+
 
     def _is_server_running(self):
-        host, port = self.server_address.split(':')
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
             try:
                 s.settimeout(1)
-                s.connect((host, int(port)))
+                s.connect((self._host, self._port))
                 return True
             except (ConnectionRefusedError, socket.timeout):
                 return False
 
-    def is_server_running(self):
-        """Public method to check server status."""
-        return self._is_server_running()
+    async def is_server_running(self):
+        """
+        Public method to check server status. Cooperative (no thread hop) and
+        cached for 5 s so back-to-back jobs skip the probe entirely.
+        """
+        if time.monotonic() < self._alive_until:
+            return True
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(self._host, self._port), timeout=0.2
+            )
+            writer.close()
+            self._alive_until = time.monotonic() + 5.0
+            return True
+        except (OSError, asyncio.TimeoutError):
+            return False
 
     def _start_server(self):
         if self._is_server_running():
@@ -62,13 +128,23 @@ class ComfyAPIManager:
         )
         
         print("Waiting for server to start...", end="", flush=True)
-        for _ in range(60):
-            time.sleep(1)
+        # Exponential backoff against the HTTP root instead of 1 s sleeps: we
+        # notice readiness within ~100 ms of the port opening, and a 200 proves
+        # the web app is actually serving, not just that the socket accepted.
+        deadline = time.monotonic() + 60
+        delay = 0.1
+        while time.monotonic() < deadline:
+            try:
+                resp = self.http.get(f"{self._http_base}/", timeout=0.5)
+                if resp.status_code == 200:
+                    print("\nServer started successfully.")
+                    return
+            except requests.RequestException:
+                pass
             print(".", end="", flush=True)
-            if self._is_server_running():
-                print("\nServer started successfully.")
-                return
-        
+            time.sleep(delay)
+            delay = min(delay * 1.5, 2.0)
+
         print("\nError: Server did not start in time.")
         self._stop_server()
         raise RuntimeError("Server failed to start.")
@@ -92,6 +168,7 @@ class ComfyAPIManager:
                 print(f"An error occurred during server shutdown: {e}")
             finally:
                 self.server_process = None
+        self._alive_until = 0.0
     
     def stop_server(self):
         """Public method to stop the server."""
@@ -100,40 +177,98 @@ class ComfyAPIManager:
     def kill_server(self):
         """Public alias for stopping the server."""
         self._stop_server()
+        self.close()
+
+    def close(self):
+        """Dispose of pooled HTTP connections (pools are recreated on demand)."""
+        self.http.close()
 
-    def _upload_image(self, filepath):
-        filename = os.path.basename(filepath)
-        with open(filepath, 'rb') as f:
-            files = {'image': (filename, f.read(), 'image/png')}
-        data = {'overwrite': 'true'}
-        resp = requests.post(f"http://{self.server_address}/upload/image", files=files, data=data)
-        resp.raise_for_status()
-        return resp.json()['name']
+    async def aclose(self):
+        """Close the async session; must be awaited from the event loop."""
+        if self._aio is not None and not self._aio.closed:
+            await self._aio.close()
 
-    def _queue_prompt(self, prompt_workflow):
+    async def _upload_image(self, image_bytes, filename):
+        session = await self._get_aio_session()
+        form = aiohttp.FormData()
+        form.add_field('image', image_bytes, filename=filename, content_type='image/png')
+        form.add_field('overwrite', 'true')
+        async with session.post(f"{self._http_base}/upload/image", data=form) as resp:
+            resp.raise_for_status()
+            return (await resp.json())['name']
+
+    async def _queue_prompt(self, prompt_workflow):
         p = {"prompt": prompt_workflow, "client_id": self.client_id}
-        data = json.dumps(p).encode('utf-8')
-        req = urllib.request.Request(f"http://{self.server_address}/prompt", data=data)
-        return json.loads(urllib.request.urlopen(req).read())
+        session = await self._get_aio_session()
+        async with session.post(f"{self._http_base}/prompt",
+                                data=_json_dumps(p),
+                                headers={'Content-Type': 'application/json'}) as resp:
+            resp.raise_for_status()
+            return _json_loads(await resp.read())
+
+    async def _get_image(self, filename, subfolder, folder_type):
+        params = {"filename": filename, "subfolder": subfolder, "type": folder_type}
+        session = await self._get_aio_session()
+        async with session.get(f"{self._http_base}/view", params=params) as resp:
+            resp.raise_for_status()
+            return await resp.read()
+
+    async def _get_history(self, prompt_id):
+        session = await self._get_aio_session()
+        async with session.get(f"{self._http_base}/history/{prompt_id}") as resp:
+            resp.raise_for_status()
+            return _json_loads(await resp.read())
 
-    def _get_image(self, filename, subfolder, folder_type):
-        data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
-        with urllib.request.urlopen(f"http://{self.server_address}/view?{urllib.parse.urlencode(data)}") as response:
-            return response.read()
+    async def _read_ws(self):
+        """Single reader for the shared websocket; resolves pending futures."""
+        session = await self._get_aio_session()
+        try:
+            async with session.ws_connect(f"{self._ws_base}/ws?clientId={self.client_id}", heartbeat=30) as ws:
+                self._ws_connected.set()
+                async for msg in ws:
+                    # Binary frames are preview images; drop them without decoding.
+                    if msg.type != aiohttp.WSMsgType.TEXT:
+                        continue
+                    # Cheap substring check to skip the per-step progress spam
+                    # before paying for a full json.loads.
+                    if '"executing"' not in msg.data[:64]:
+                        continue
+                    message = _json_loads(msg.data)
+                    if message['type'] == 'executing' and message['data']['node'] is None:
+                        prompt_id = message['data']['prompt_id']
+                        # Resolve in place: await_result owns removal from
+                        # _pending, so a pre-queued job that hasn't awaited yet
+                        # still finds its resolution later.
+                        fut = self._pending.get(prompt_id)
+                        if fut is not None and not fut.done():
+                            fut.set_result(None)
+                        else:
+                            self._finished.add(prompt_id)
+        finally:
+            self._ws_connected.clear()
+            # Don't leave callers hanging if the socket dies (e.g. server
+            # killed). Entries stay in _pending so a later await_result can
+            # still retrieve the exception instead of hitting a KeyError.
+            for fut in self._pending.values():
+                if not fut.done():
+                    fut.set_exception(RuntimeError("ComfyUI websocket closed during execution."))
 
-    def _get_history(self, prompt_id):
-        with urllib.request.urlopen(f"http://{self.server_address}/history/{prompt_id}") as response:
-            return json.loads(response.read())
+    async def _ensure_ws_reader(self):
+        if self._ws_reader is None or self._ws_reader.done():
+            self._ws_reader = asyncio.create_task(self._read_ws())
+        await asyncio.wait_for(self._ws_connected.wait(), timeout=10)
 
-    def run_workflow(self, input_image_path, positive_prompt, output_filename="flux_output.png"):
+    async def prepare(self, image_bytes, positive_prompt, image_name="input.png"):
         """
-        Runs the workflow on an already-started server. Does NOT manage server lifecycle.
+        Uploads the input image (in-memory bytes) and queues the prompt,
+        returning its prompt_id. Safe to call while a previous prompt is still
+        executing, so the HTTP round trips overlap GPU time. image_name must be
+        unique per job so pre-queued uploads can't overwrite each other.
         """
-        uploaded_filename = self._upload_image(input_image_path)
-        with open(self.workflow_api_json_path, 'r', encoding='utf-8') as f:
-            prompt = json.load(f)
+        uploaded_filename = await self._upload_image(image_bytes, image_name)
+        prompt = _json_loads(self._workflow_bytes)
 
-        img = Image.open(input_image_path)
+        img = Image.open(io.BytesIO(image_bytes))
         width, height = img.size
 
         # --- THE CORRECT FIX ---
@@ -159,30 +294,44 @@ class ComfyAPIManager:
         prompt[self.load_image_node_id]["inputs"]["image"] = uploaded_filename
         prompt[self.clip_text_node_id]["inputs"]["text"] = positive_prompt
 
-        ws = websocket.WebSocket()
-        ws.connect(f"ws://{self.server_address}/ws?clientId={self.client_id}")
-        prompt_id = self._queue_prompt(prompt)['prompt_id']
-        
-        print("Workflow queued. Waiting for execution to finish...")
-        try:
-            while True:
-                out = ws.recv()
-                if isinstance(out, str):
-                    message = json.loads(out)
-                    if message['type'] == 'executing' and message['data']['node'] is None and message['data']['prompt_id'] == prompt_id:
-                        break
-        finally:
-            ws.close()
+        await self._ensure_ws_reader()
+        prompt_id = (await self._queue_prompt(prompt))['prompt_id']
+        if prompt_id not in self._finished:
+            self._pending[prompt_id] = asyncio.get_running_loop().create_future()
+        print("Workflow queued.")
+        return prompt_id
+
+    async def await_result(self, prompt_id):
+        """Waits for a queued prompt to finish and returns the output image bytes."""
+        if prompt_id in self._finished:
+            self._finished.discard(prompt_id)
+            self._pending.pop(prompt_id, None)
+        elif prompt_id in self._pending:
+            print("Waiting for execution to finish...")
+            try:
+                await self._pending[prompt_id]
+            finally:
+                self._pending.pop(prompt_id, None)
+        else:
+            raise RuntimeError(
+                f"Prompt {prompt_id} was lost: the ComfyUI server or websocket "
+                "went away before it finished."
+            )
         print("Execution finished.")
 
-        history = self._get_history(prompt_id)[prompt_id]
+        history = (await self._get_history(prompt_id))[prompt_id]
         for node_id in history['outputs']:
             if 'images' in history['outputs'][node_id]:
                 image_data = history['outputs'][node_id]['images'][0]
-                image_bytes = self._get_image(image_data['filename'], image_data['subfolder'], image_data['type'])
-                with open(output_filename, 'wb') as f:
-                    f.write(image_bytes)
-                print(f"Saved output image to '{output_filename}'")
-                return output_filename
-        
+                image_bytes = await self._get_image(image_data['filename'], image_data['subfolder'], image_data['type'])
+                print(f"Fetched output image ({len(image_bytes)} bytes).")
+                return image_bytes
+
         return None
+
+    async def run_workflow(self, image_bytes, positive_prompt, image_name="input.png"):
+        """
+        Runs the workflow on an already-started server. Does NOT manage server lifecycle.
+        """
+        prompt_id = await self.prepare(image_bytes, positive_prompt, image_name)
+        return await self.await_result(prompt_id)
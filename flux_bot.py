@@ -1,10 +1,13 @@
 # flux_bot.py
 
+import atexit
+import io
 import logging
+import concurrent.futures
+import itertools
 import os
-import uuid
 import asyncio
-import glob
+import functools
 import re
 import subprocess
 import time
@@ -12,10 +15,22 @@ from datetime import datetime
 from dotenv import load_dotenv
 from telegram import Update, Document
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.helpers import escape_markdown
+from telegram.request import HTTPXRequest
 from PIL import Image
 
 from comfy_api_manager import ComfyAPIManager
 
+# NVML gives us VRAM usage as a direct library call (microseconds) instead of
+# fork+exec of nvidia-smi per poll; fall back to the shell path without it.
+try:
+    import pynvml
+    pynvml.nvmlInit()
+    _nvml_handle = pynvml.nvmlDeviceGetHandleByIndex(0)
+except Exception:
+    pynvml = None
+    _nvml_handle = None
+
 # --- Setup ---
 load_dotenv()
 logging.basicConfig(
@@ -29,6 +44,12 @@ TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 if not TELEGRAM_TOKEN:
     raise ValueError("TELEGRAM_TOKEN not found in .env file. Please create it and add your token.")
 
+# Optional self-hosted Bot API server (telegram-bot-api). When set, get_file
+# returns local filesystem paths, so image "downloads" become local reads and
+# skip the round trip through Telegram's edge (and its 20 MB bot limit).
+# Example: LOCAL_BOT_API_URL=http://127.0.0.1:8081
+LOCAL_BOT_API_URL = os.getenv("LOCAL_BOT_API_URL")
+
 COMFYUI_PATH = "/home/duxon/Tools/ComfyUI"
 CONDA_ENV = "comfyui"
 WORKFLOW_PATH = "FLUX-Kontext-Python.json"
@@ -42,29 +63,77 @@ GENERATION_TIME_MINUTES = 5
 VRAM_THRESHOLD_PERCENT = 20
 VRAM_POLL_INTERVAL_SECONDS = 300 # 5 minutes
 
+USER_DATA_TTL_SECONDS = 3600
+USER_DATA_MAX_ENTRIES = 10_000
+
 manager = ComfyAPIManager(SERVER_ADDRESS, CONDA_ENV, COMFYUI_PATH, WORKFLOW_PATH, NODE_IDS)
+# Per-chat half-finished requests (awaiting image or prompt). Entries carry a
+# "created" timestamp and are pruned on access so abandoned submissions can't
+# pin image bytes forever.
 user_data = {}
-job_queue = asyncio.Queue()
+
+def prune_user_data():
+    now = time.monotonic()
+    stale = [cid for cid, entry in user_data.items()
+             if now - entry["created"] > USER_DATA_TTL_SECONDS]
+    for cid in stale:
+        user_data.pop(cid, None)
+    # dicts iterate in insertion order, so this evicts the oldest entries.
+    while len(user_data) > USER_DATA_MAX_ENTRIES:
+        user_data.pop(next(iter(user_data)))
+
+class DrainableQueue(asyncio.Queue):
+    """asyncio.Queue with an O(1) drain that settles task_done bookkeeping."""
+
+    def drain(self):
+        jobs = list(self._queue)
+        self._queue.clear()
+        # Cleared jobs will never see task_done(); settle their unfinished
+        # count here so join() can't hang on them.
+        if jobs:
+            self._unfinished_tasks -= len(jobs)
+            if self._unfinished_tasks <= 0:
+                self._unfinished_tasks = 0
+                self._finished.set()
+        return jobs
+
+# Bounded so a flood of requests can't pin unbounded image bytes in memory;
+# a single worker coroutine pulls from this queue (one GPU, one worker).
+job_queue = DrainableQueue(maxsize=200)
 generation_count = 0
+# Monotonic job counters: position in line is submitted - completed, which
+# stays correct even when the worker pulls a job early to pre-queue it
+# (qsize would under-count by one in that window). /kill advances completed
+# for the jobs it clears.
+submitted_jobs = 0
+completed_jobs = 0
+# Set by the background monitor whenever VRAM is below the threshold; jobs
+# that need a server start wait on this instead of polling themselves.
+vram_available = asyncio.Event()
+# Sequence for per-job ComfyUI upload names (see handle_image).
+_image_seq = itertools.count()
 
 # --- Helper Functions ---
 
 def cleanup_workspace():
+    # Leftovers only exist from pre-in-memory versions of the bot, but they
+    # are cheap to sweep. A single scandir pass avoids the double glob.
     logger.info("Cleaning up workspace from previous runs...")
-    input_files = glob.glob("input_*.png")
-    output_files = glob.glob("flux_output.png")
-    
-    for f_path in input_files + output_files:
-        try:
-            os.remove(f_path)
-            logger.info(f"Removed leftover file: {f_path}")
-        except OSError as e:
-            logger.error(f"Error removing file {f_path}: {e}")
-
-def resize_image(image_path):
+    with os.scandir('.') as it:
+        for entry in it:
+            name = entry.name
+            if (name.startswith('input_') and name.endswith('.png')) or name == 'flux_output.png':
+                try:
+                    os.unlink(entry.path)
+                    logger.info(f"Removed leftover file: {name}")
+                except OSError as e:
+                    logger.error(f"Error removing file {name}: {e}")
+
+def resize_image(image_bytes):
     # This is the correct function. It only downsizes very large images.
+    # Works on in-memory bytes; returns (image_bytes, was_resized).
     max_size = 1400
-    img = Image.open(image_path)
+    img = Image.open(io.BytesIO(image_bytes))
     width, height = img.size
     if width > max_size or height > max_size:
         if width > height:
@@ -74,27 +143,70 @@ def resize_image(image_path):
             new_height = max_size
             new_width = int(max_size * width / height)
         img = img.resize((new_width, new_height), Image.LANCZOS)
-        img.save(image_path)
+        buf = io.BytesIO()
+        # Fastest zlib level: the PNG only travels to ComfyUI over loopback,
+        # so encode CPU matters far more than a few hundred KB of size.
+        img.save(buf, format='PNG', compress_level=1)
         logger.info(f"Image was too large, resized to {new_width}x{new_height}.")
-        return True
-    return False
+        return buf.getvalue(), True
+    return image_bytes, False
+
+# Persistent, line-buffered log handle: log_generation runs in the critical
+# path right after each send, so skip the open/close syscall pair per write.
+_log_fh = open("generation_log.txt", "a", buffering=1)
+atexit.register(_log_fh.close)
 
 def log_generation():
     """Logs the timestamp of a successful generation."""
-    log_message = f"Image generated at: {datetime.now().isoformat()}\n"
     try:
-        with open("generation_log.txt", "a") as log_file:
-            log_file.write(log_message)
-    except IOError as e:
-        logger.error(f"Failed to write to generation_log.txt: {e}")       
+        _log_fh.write(f"Image generated at: {datetime.now().isoformat()}\n")
+    except (IOError, ValueError) as e:
+        logger.error(f"Failed to write to generation_log.txt: {e}")
+
+# Dedicated single thread for ComfyUI server lifecycle calls: start_server can
+# block for up to a minute, and pinning it here keeps the default pool free
+# for the short helpers and avoids interleaved start/stop from two threads.
+COMFY_EXEC = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="comfy")
+
+def _to_exec(func, *args, executor=None):
+    """
+    Offloads a blocking call like asyncio.to_thread, minus its per-call
+    contextvars copy — this bot sets no context vars. Use functools.partial
+    for keyword arguments.
+    """
+    return asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+def _read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def _tail(path, num_lines, block_size=4096):
+    """Returns the last num_lines lines of a file, reading only its tail."""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        data = b''
+        while end > 0 and data.count(b'\n') <= num_lines:
+            start = max(0, end - block_size)
+            f.seek(start)
+            data = f.read(end - start) + data
+            end = start
+    return data.decode('utf-8', errors='replace').splitlines()[-num_lines:]
 
 async def check_vram():
-    # (No changes to this function)
-    """Checks if VRAM usage is below the threshold using nvidia-smi in a non-blocking way."""
+    """Checks if VRAM usage is below the threshold, preferring NVML over nvidia-smi."""
+    if _nvml_handle is not None:
+        try:
+            info = pynvml.nvmlDeviceGetMemoryInfo(_nvml_handle)
+            usage_percent = (info.used / info.total) * 100
+            logger.info(f"Current VRAM usage: {usage_percent:.2f}% ({info.used // 2**20}/{info.total // 2**20} MiB)")
+            return usage_percent < VRAM_THRESHOLD_PERCENT
+        except pynvml.NVMLError as e:
+            logger.warning(f"NVML query failed ({e}); falling back to nvidia-smi.")
     try:
         command = "nvidia-smi --query-gpu=memory.used,memory.total --format=csv,noheader,nounits"
-        result = await asyncio.to_thread(
-            subprocess.check_output, command, shell=True, text=True
+        result = await _to_exec(
+            functools.partial(subprocess.check_output, command, shell=True, text=True)
         )
         used, total = map(int, re.split(r',\s*', result.strip()))
         usage_percent = (used / total) * 100
@@ -107,83 +219,120 @@ async def check_vram():
         logger.error(f"An error occurred checking VRAM: {e}")
         return True
 
+async def vram_monitor():
+    """
+    Single background poller for the VRAM gate. Checks rarely while VRAM is
+    free and backs off from 10 s while it is busy, so queued jobs unblock
+    within seconds of capacity freeing up instead of a fixed 5-minute poll.
+    """
+    backoff = 10
+    while True:
+        if await check_vram():
+            vram_available.set()
+            backoff = 10
+            await asyncio.sleep(VRAM_POLL_INTERVAL_SECONDS)
+        else:
+            vram_available.clear()
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, VRAM_POLL_INTERVAL_SECONDS)
+
 # --- Core Bot Logic ---
 
 async def worker():
     """The single consumer that processes jobs from the queue one by one."""
-    global generation_count
+    global generation_count, completed_jobs
+    prepared = None  # (job, prompt_id) already queued on the server while the previous job ran
     while True:
-        job = await job_queue.get()
+        if prepared is not None:
+            job, prompt_id = prepared
+            prepared = None
+        else:
+            job = await job_queue.get()
+            prompt_id = None
         chat_id = job["chat_id"]
         prompt = job["prompt"]
-        image_path = job["image_path"]
         context = job["context"]
         prompt_message_id = job["prompt_message_id"]
         sent_as_document = job["sent_as_document"]
+        output_image_bytes = None
+        status_message = None
 
         try:
-            # --- MODIFIED LOGIC: VRAM CHECK & RESTART ---
-            if generation_count >= 3:
-                logger.info("Generation count reached 3. Restarting ComfyUI server.")
-                await asyncio.to_thread(manager.stop_server)
-                generation_count = 0
-
-            server_was_running = await asyncio.to_thread(manager.is_server_running)
-
-            if not server_was_running:
-                wait_message = None
-                while not await check_vram():
-                    message_text = f"High VRAM usage detected. Your job is paused. Will check again in {VRAM_POLL_INTERVAL_SECONDS // 60} minutes."
-                    if wait_message:
-                        await context.bot.edit_message_text(chat_id=chat_id, message_id=wait_message.message_id, text=message_text + f"\n(Last checked: {datetime.now().strftime('%H:%M:%S')})")
-                    else:
-                        wait_message = await context.bot.send_message(chat_id, message_text, reply_to_message_id=prompt_message_id)
-                    await asyncio.sleep(VRAM_POLL_INTERVAL_SECONDS)
-                
-                if wait_message:
-                     await context.bot.edit_message_text(chat_id=chat_id, message_id=wait_message.message_id, text="✅ VRAM is now available. Starting your job...")
-            
-            # --- END MODIFIED LOGIC ---
-
-            await asyncio.to_thread(manager.start_server)
-            logger.info("Server started. Adding a 5-second delay to ensure it's fully ready.")
-            await asyncio.sleep(5)
-
-            await context.bot.send_message(chat_id, f"✅ Starting generation process... This will take around {GENERATION_TIME_MINUTES} minutes.", reply_to_message_id=prompt_message_id)
-            
-            output_image_path = await asyncio.to_thread(
-                manager.run_workflow,
-                input_image_path=image_path,
-                positive_prompt=prompt
-            )
-
-            if output_image_path and os.path.exists(output_image_path):
+            # A pre-queued job (prompt_id set) is already on the running server,
+            # so the lifecycle checks only apply when we still have to submit.
+            if prompt_id is None:
+                # --- MODIFIED LOGIC: VRAM CHECK & RESTART ---
+                if generation_count >= 3:
+                    logger.info("Generation count reached 3. Restarting ComfyUI server.")
+                    await _to_exec(manager.stop_server, executor=COMFY_EXEC)
+                    generation_count = 0
+                    # Our own server just released its VRAM.
+                    vram_available.set()
+
+                server_was_running = await manager.is_server_running()
+
+                if not server_was_running and not vram_available.is_set():
+                    wait_message = await context.bot.send_message(chat_id, "High VRAM usage detected. Your job is paused and will start as soon as VRAM frees up.", reply_to_message_id=prompt_message_id)
+                    await vram_available.wait()
+                    await context.bot.edit_message_text(chat_id=chat_id, message_id=wait_message.message_id, text="✅ VRAM is now available. Starting your job...")
+
+                # --- END MODIFIED LOGIC ---
+
+                await _to_exec(manager.start_server, executor=COMFY_EXEC)
+                logger.info("Server started. Adding a 5-second delay to ensure it's fully ready.")
+                await asyncio.sleep(5)
+
+            # One status message, edited through the job lifecycle: each extra
+            # send_message is a full HTTPS round trip to Telegram.
+            status_message = await context.bot.send_message(chat_id, f"✅ Starting generation process... This will take around {GENERATION_TIME_MINUTES} minutes.", reply_to_message_id=prompt_message_id)
+
+            if prompt_id is None:
+                prompt_id = await manager.prepare(job["image_bytes"], prompt, job["image_name"])
+
+            # While the GPU is busy, push the next waiting job's upload and
+            # prompt-queue so its HTTP round trips hide behind compute. Skip
+            # when the periodic restart is due next: restarting the server
+            # would drop the pre-queued prompt.
+            if not job_queue.empty() and generation_count + 1 < 3:
+                next_job = job_queue.get_nowait()
+                try:
+                    next_prompt_id = await manager.prepare(next_job["image_bytes"], next_job["prompt"], next_job["image_name"])
+                    prepared = (next_job, next_prompt_id)
+                except Exception as e:
+                    logger.error(f"Could not pre-queue next job, will submit it normally: {e}")
+                    prepared = (next_job, None)
+
+            output_image_bytes = await manager.await_result(prompt_id)
+
+            if output_image_bytes:
                 log_generation()
                 generation_count += 1
-                await context.bot.send_message(chat_id, "Generation complete! Sending your image...", reply_to_message_id=prompt_message_id)
+                await context.bot.edit_message_text(chat_id=chat_id, message_id=status_message.message_id, text="Generation complete! Sending your image...")
+                # The result never touches disk: the bytes from ComfyUI's
+                # /view endpoint go straight into the Telegram upload.
                 if sent_as_document:
-                    await context.bot.send_document(chat_id, document=open(output_image_path, 'rb'), reply_to_message_id=prompt_message_id)
+                    await context.bot.send_document(chat_id, document=output_image_bytes, filename="flux_output.png", reply_to_message_id=prompt_message_id)
                 else:
-                    await context.bot.send_photo(chat_id, photo=open(output_image_path, 'rb'), reply_to_message_id=prompt_message_id)
+                    await context.bot.send_photo(chat_id, photo=output_image_bytes, reply_to_message_id=prompt_message_id)
             else:
-                await context.bot.send_message(chat_id, "Sorry, the generation failed to produce an image.", reply_to_message_id=prompt_message_id)
+                await context.bot.edit_message_text(chat_id=chat_id, message_id=status_message.message_id, text="Sorry, the generation failed to produce an image.")
 
         except Exception as e:
             logger.error(f"An error occurred during generation for chat {chat_id}: {e}")
-            await context.bot.send_message(chat_id, f"An error occurred: {e}", reply_to_message_id=prompt_message_id)
-        
+            error_text = f"An error occurred: {e}"
+            try:
+                if status_message:
+                    await context.bot.edit_message_text(chat_id=chat_id, message_id=status_message.message_id, text=error_text)
+                else:
+                    await context.bot.send_message(chat_id, error_text, reply_to_message_id=prompt_message_id)
+            except Exception as notify_error:
+                logger.error(f"Failed to notify chat {chat_id} of the error: {notify_error}")
+
         finally:
-            logger.info(f"Cleaning up files for chat {chat_id}.")
-            if os.path.exists(image_path):
-                os.remove(image_path)
-            if 'output_image_path' in locals() and os.path.exists(output_image_path):
-                os.remove(output_image_path)
-            
+            completed_jobs += 1
             job_queue.task_done()
-            if job_queue.empty():
-                logger.info("Job queue is empty. Shutting down ComfyUI server.")
-                await asyncio.to_thread(manager.stop_server)
-                generation_count = 0
+            # The server stays up between jobs so the next request skips the
+            # FLUX model reload; it is stopped only on shutdown or /kill.
 
 # --- Telegram Handlers (No changes below this line) ---
 # ... (The rest of the file remains unchanged)
@@ -195,59 +344,62 @@ async def log_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     num_lines = 20
 
     try:
-        if not os.path.exists(log_file_path):
+        # Seek-from-end tail: reads a few KiB regardless of how large the log
+        # has grown, and keeps the read off the event loop. Let the open fail
+        # instead of stat-ing first (one syscall, no TOCTOU race).
+        try:
+            recent_lines = await _to_exec(_tail, log_file_path, num_lines)
+        except FileNotFoundError:
             await update.message.reply_text("No log file found yet.")
             return
 
-        with open(log_file_path, "r") as f:
-            lines = f.readlines()
-
-        if not lines:
+        if not recent_lines:
             await update.message.reply_text("The log file is empty.")
             return
 
-        recent_lines = lines[-num_lines:]
-        log_content = "".join(recent_lines)
-        
-        message = f"Here are the last {len(recent_lines)} log entries:\n```\n{log_content}```"
-        await update.message.reply_text(message, parse_mode='Markdown')
+        log_content = "\n".join(recent_lines) + "\n"
+
+        escaped_content = escape_markdown(log_content, version=2, entity_type='pre')
+        message = f"Here are the last {len(recent_lines)} log entries:\n```\n{escaped_content}```"
+        await update.message.reply_text(message, parse_mode='MarkdownV2')
 
     except Exception as e:
         logger.error(f"Error reading log file: {e}")
         await update.message.reply_text("Sorry, there was an error reading the log file.")
 
 async def kill(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global generation_count
+    global generation_count, completed_jobs
     chat_id = update.message.chat_id
     logger.warning(f"Kill command issued by user {chat_id}.")
     
-    jobs_cleared = 0
-    waiting_jobs = []
-    while not job_queue.empty():
-        try:
-            waiting_jobs.append(job_queue.get_nowait())
-            jobs_cleared += 1
-        except asyncio.QueueEmpty:
-            break
-    
-    manager.kill_server()
+    waiting_jobs = job_queue.drain()
+    jobs_cleared = len(waiting_jobs)
+    # Cleared jobs never reach the worker's finally, so settle the position
+    # counters here.
+    completed_jobs += jobs_cleared
+
+    # Through the lifecycle executor: kill_server blocks ~3 s in _stop_server,
+    # and serializing it there prevents interleaving with a concurrent
+    # start_server (PREWARM or the worker warming up).
+    await _to_exec(manager.kill_server, executor=COMFY_EXEC)
+    await manager.aclose()
     generation_count = 0
+    vram_available.set()
     await update.message.reply_text(f"🚨 Server process killed. {jobs_cleared} job(s) in the queue were cleared.")
 
-    for job in waiting_jobs:
-        user_id_to_notify = job["chat_id"]
-        image_to_delete = job["image_path"]
-        if os.path.exists(image_to_delete):
-            os.remove(image_to_delete)
-        
-        try:
-            await context.bot.send_message(
-                user_id_to_notify,
-                "Looks like the admin tripped over the power cord. 🔌\n\n"
-                "The generation process has been abruptly stopped. Please submit your request again."
-            )
-        except Exception as e:
-            logger.error(f"Failed to send kill notification to {user_id_to_notify}: {e}")
+    # Fire all notifications concurrently: with N waiting users a sequential
+    # loop pays N HTTPS round trips of wall time instead of ~1.
+    notify_text = (
+        "Looks like the admin tripped over the power cord. 🔌\n\n"
+        "The generation process has been abruptly stopped. Please submit your request again."
+    )
+    results = await asyncio.gather(
+        *(context.bot.send_message(job["chat_id"], notify_text) for job in waiting_jobs),
+        return_exceptions=True,
+    )
+    for job, result in zip(waiting_jobs, results):
+        if isinstance(result, Exception):
+            logger.error(f"Failed to send kill notification to {job['chat_id']}: {result}")
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -266,36 +418,47 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Your request will be processed in the order it was received."
     )
 
-async def handle_request(context: ContextTypes.DEFAULT_TYPE, update: Update, prompt: str, image_path: str, prompt_message_id: int, sent_as_document: bool):
+async def handle_request(context: ContextTypes.DEFAULT_TYPE, update: Update, prompt: str, image_bytes: bytes, image_name: str, prompt_message_id: int, sent_as_document: bool):
     """Adds a job to the queue and notifies the user of their position."""
+    global submitted_jobs
     chat_id = update.message.chat_id
-    
-    position = job_queue.qsize() + 1
+
+    position = submitted_jobs - completed_jobs + 1
     wait_time = (position - 1) * GENERATION_TIME_MINUTES
 
+    job = {"chat_id": chat_id, "prompt": prompt, "image_bytes": image_bytes, "image_name": image_name, "context": context, "prompt_message_id": prompt_message_id, "sent_as_document": sent_as_document}
+    # Enqueue synchronously so the handler returns in O(1) no matter how deep
+    # the backlog is; a full queue is reported instead of awaited on.
+    try:
+        job_queue.put_nowait(job)
+    except asyncio.QueueFull:
+        await context.bot.send_message(chat_id, "Sorry, the queue is completely full right now. Please try again later.", reply_to_message_id=prompt_message_id)
+        return
+    submitted_jobs += 1
+
     if wait_time > 0:
-        await context.bot.send_message(chat_id, f"Got it! You are number **{position}** in the queue.\nEstimated wait time is ~{wait_time} minutes.", parse_mode='Markdown', reply_to_message_id=prompt_message_id)
+        await context.bot.send_message(chat_id, f"Got it! You are number {position} in the queue.\nEstimated wait time is ~{wait_time} minutes.", reply_to_message_id=prompt_message_id)
     else:
         await context.bot.send_message(chat_id, "Got it! Your request is next in line.", reply_to_message_id=prompt_message_id)
-    
-    job = {"chat_id": chat_id, "prompt": prompt, "image_path": image_path, "context": context, "prompt_message_id": prompt_message_id, "sent_as_document": sent_as_document}
-    await job_queue.put(job)
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    prune_user_data()
     chat_id = update.message.chat_id
     prompt = update.message.text
     prompt_message_id = update.message.message_id
 
     if chat_id in user_data and user_data[chat_id]["state"] == "awaiting_prompt":
-        image_path = user_data[chat_id]["image_path"]
+        image_bytes = user_data[chat_id]["image_bytes"]
+        image_name = user_data[chat_id]["image_name"]
         sent_as_document = user_data[chat_id]["sent_as_document"]
         user_data.pop(chat_id, None)
-        await handle_request(context, update, prompt, image_path, prompt_message_id, sent_as_document)
+        await handle_request(context, update, prompt, image_bytes, image_name, prompt_message_id, sent_as_document)
     else:
-        user_data[chat_id] = {"state": "awaiting_image", "prompt": prompt, "prompt_message_id": prompt_message_id}
+        user_data[chat_id] = {"state": "awaiting_image", "prompt": prompt, "prompt_message_id": prompt_message_id, "created": time.monotonic()}
         await update.message.reply_text("Got your prompt! Now, please send me the image.")
 
 async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    prune_user_data()
     chat_id = update.message.chat_id
     image_message_id = update.message.message_id
     sent_as_document = False
@@ -309,32 +472,62 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     file = await context.bot.get_file(file_id)
-    image_path = f"input_{uuid.uuid4()}.png"
-    await file.download_to_drive(image_path)
-
-    if resize_image(image_path):
+    # Keep the image in memory: it goes straight to ComfyUI over localhost, so
+    # there is no need to round-trip it through the filesystem.
+    if file.file_path and file.file_path.startswith('/'):
+        # Local Bot API server: file_path is already on this machine.
+        image_bytes = await _to_exec(_read_bytes, file.file_path)
+    else:
+        image_bytes = bytes(await file.download_as_bytearray())
+    # Counter-based name: unique within this single-process bot, with the pid
+    # guarding against collisions with uploads from a previous run.
+    image_name = f"input_{os.getpid()}_{next(_image_seq)}.png"
+
+    # PIL decode/resize/encode can take hundreds of ms on large photos; keep
+    # it off the event loop so other users' handlers aren't stalled.
+    image_bytes, was_resized = await _to_exec(resize_image, image_bytes)
+    if was_resized:
         # Correct the message to match the max_size variable
         await update.message.reply_text("Image resized to a max of 1400 pixels to prevent errors.")
 
     prompt = update.message.caption
 
     if prompt:
-        await handle_request(context, update, prompt, image_path, image_message_id, sent_as_document)
+        await handle_request(context, update, prompt, image_bytes, image_name, image_message_id, sent_as_document)
     elif chat_id in user_data and user_data[chat_id]["state"] == "awaiting_image":
         saved_prompt = user_data[chat_id]["prompt"]
         prompt_message_id = user_data[chat_id]["prompt_message_id"]
         user_data.pop(chat_id, None)
-        await handle_request(context, update, saved_prompt, image_path, prompt_message_id, sent_as_document)
+        await handle_request(context, update, saved_prompt, image_bytes, image_name, prompt_message_id, sent_as_document)
     else:
-        user_data[chat_id] = {"state": "awaiting_prompt", "image_path": image_path, "sent_as_document": sent_as_document}
+        user_data[chat_id] = {"state": "awaiting_prompt", "image_bytes": image_bytes, "image_name": image_name, "sent_as_document": sent_as_document, "created": time.monotonic()}
         await update.message.reply_text("Got your image! Now, please send me a text prompt for it.")
 
 async def post_init(application: Application):
     logger.info("Application initialized. Starting background worker.")
     asyncio.create_task(worker())
+    asyncio.create_task(vram_monitor())
+    # Optional pre-warm: load the FLUX model before the first job arrives so
+    # the first user doesn't pay the 30-60 s cold start. Off by default since
+    # it keeps VRAM occupied even if no jobs ever come in.
+    if os.getenv("PREWARM") == "1":
+        logger.info("PREWARM=1: starting ComfyUI server ahead of the first job.")
+        fut = _to_exec(manager.start_server, executor=COMFY_EXEC)
+        # Observe the result so a failed pre-warm is logged instead of dying
+        # as a never-retrieved exception at GC time.
+        fut.add_done_callback(
+            lambda f: logger.error(f"Pre-warm failed: {f.exception()}") if f.exception() else None
+        )
 
 def main():
-    application = Application.builder().token(TELEGRAM_TOKEN).post_init(post_init).build()
+    atexit.register(manager.kill_server)
+    # A roomier connection pool keeps api.telegram.org connections alive
+    # across generations, so multi-MB image uploads skip connection setup.
+    request = HTTPXRequest(connection_pool_size=16)
+    builder = Application.builder().token(TELEGRAM_TOKEN).request(request).post_init(post_init)
+    if LOCAL_BOT_API_URL:
+        builder = builder.base_url(f"{LOCAL_BOT_API_URL}/bot").base_file_url(f"{LOCAL_BOT_API_URL}/file/bot").local_mode(True)
+    application = builder.build()
 
     application.add_handler(CommandHandler("log", log_command))
     application.add_handler(CommandHandler("kill", kill))